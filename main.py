@@ -1,22 +1,66 @@
 import asyncio
+import atexit
+import glob
+import io
 import os
 import re
 import shutil
+import sqlite3
+import tempfile
+import threading
 import time
 import uuid
 import logging
-from concurrent.futures import ThreadPoolExecutor
-import requests
+import multiprocessing
+import pathlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiohttp
 import yt_dlp
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait
+from pyrogram.handlers import CallbackQueryHandler, MessageHandler
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
+from mutagen.mp3 import MP3
 import subprocess
 from dotenv import load_dotenv
 
+# File where the discovered ffmpeg path is remembered between restarts
+FFMPEG_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'youtubebot', 'ffmpeg_path')
+
+
+def read_cached_ffmpeg_path():
+    """Return the cached ffmpeg path if it still points to an executable."""
+    try:
+        with open(FFMPEG_CACHE_FILE, 'r') as f:
+            path = f.read().strip()
+    except OSError:
+        return None
+    if path and os.access(path, os.X_OK):
+        return path
+    return None
+
+
+def write_cached_ffmpeg_path(path):
+    """Remember the discovered ffmpeg path for the next startup."""
+    try:
+        os.makedirs(os.path.dirname(FFMPEG_CACHE_FILE), exist_ok=True)
+        with open(FFMPEG_CACHE_FILE, 'w') as f:
+            f.write(path)
+    except OSError as e:
+        logging.debug("Could not cache ffmpeg path: %s", e)
+    return path
+
+
 # Find ffmpeg path
 def find_ffmpeg_path():
     try:
+        # Reuse the path found on a previous startup
+        cached_path = read_cached_ffmpeg_path()
+        if cached_path:
+            return cached_path
+
         # For Windows, check common installation paths
         if os.name == 'nt':
             common_paths = [
@@ -26,13 +70,13 @@ def find_ffmpeg_path():
             ]
             for path in common_paths:
                 if os.path.exists(path):
-                    return path
+                    return write_cached_ffmpeg_path(path)
                     
             # Try to get path from where command is found
             try:
                 result = subprocess.run(['where', 'ffmpeg'], capture_output=True, text=True, check=True)
                 if result.stdout.strip():
-                    return result.stdout.strip().split('\n')[0]
+                    return write_cached_ffmpeg_path(result.stdout.strip().split('\n')[0])
             except (subprocess.SubprocessError, FileNotFoundError):
                 pass
         else:
@@ -40,7 +84,7 @@ def find_ffmpeg_path():
             try:
                 result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True, check=True)
                 if result.stdout.strip():
-                    return result.stdout.strip()
+                    return write_cached_ffmpeg_path(result.stdout.strip())
             except (subprocess.SubprocessError, FileNotFoundError):
                 pass
         
@@ -51,12 +95,13 @@ def find_ffmpeg_path():
 
 # Get ffmpeg path
 FFMPEG_PATH = find_ffmpeg_path()
-if FFMPEG_PATH:
-    print(f"FFmpeg found at: {FFMPEG_PATH}")
-else:
-    print("WARNING: FFmpeg not found. Some video formats may not download correctly.")
+FFMPEG_FOUND = FFMPEG_PATH is not None
+if not FFMPEG_FOUND:
     FFMPEG_PATH = 'ffmpeg'  # Fallback to just the command name
 
+# Use aria2c for video downloads when it is installed
+ARIA2C_PATH = shutil.which('aria2c')
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -64,6 +109,10 @@ load_dotenv()
 WHITELIST_ENABLED = os.getenv('WHITELIST_ENABLED', 'false').lower() in ('true', '1', 'yes', 'on')
 WHITELIST = [int(user_id.strip()) for user_id in os.getenv('WHITELIST', '').split(',') if user_id.strip()]
 
+# Number of DASH/HLS fragments yt-dlp downloads in parallel. YouTube may throttle
+# each connection, so fetching several fragments at once helps saturate bandwidth.
+YTDL_CONCURRENT_FRAGMENTS = int(os.getenv('YTDL_CONCURRENT_FRAGMENTS', '4'))
+
 # Get cookies path from environment and make it absolute based on script location
 cookies_path_config = os.getenv('COOKIES_PATH', 'cookies.txt')
 # Get the directory where this script is located
@@ -71,12 +120,6 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Join script directory with cookies path from config to make an absolute path
 COOKIES_PATH = os.path.join(SCRIPT_DIR, cookies_path_config)
 
-# Validate cookies path
-if not os.path.exists(COOKIES_PATH):
-    print(f"Warning: Cookie file not found at {COOKIES_PATH}")
-else:
-    print(f"Cookie file found at {COOKIES_PATH}")
-
 
 def is_user_allowed(user_id: int) -> bool:
     """Check if user is allowed to use the bot."""
@@ -87,13 +130,44 @@ def is_user_allowed(user_id: int) -> bool:
     return user_id in WHITELIST
 
 
-# Initialize the bot
-app = Client(
-    "youtube_quality_bot",
-    api_id=os.getenv('API_ID'),
-    api_hash=os.getenv('API_HASH'),
-    bot_token=os.getenv('BOT_TOKEN')
-)
+def print_startup_status():
+    """Print which optional tools and settings were found."""
+    if FFMPEG_FOUND:
+        print(f"FFmpeg found at: {FFMPEG_PATH}")
+    else:
+        print("WARNING: FFmpeg not found. Some video formats may not download correctly.")
+
+    if ARIA2C_PATH:
+        print(f"aria2c found at: {ARIA2C_PATH}")
+
+    # Validate cookies path
+    if not os.path.exists(COOKIES_PATH):
+        print(f"Warning: Cookie file not found at {COOKIES_PATH}")
+    else:
+        print(f"Cookie file found at {COOKIES_PATH}")
+
+    print("🤖 Starting...")
+
+    # Print whitelist status
+    if WHITELIST_ENABLED:
+        print(f"🔒 Whitelist enabled: {len(WHITELIST)} authorized users")
+    else:
+        print("🌐 Public mode: Bot is open to all users")
+
+
+def install_uvloop():
+    """Use uvloop for faster event loop scheduling where available.
+
+    This must happen before the client and any asyncio primitives are created,
+    since they grab the event loop on init.
+    """
+    if os.name == 'nt':
+        return
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
 
 
 # Error handling wrapper
@@ -113,29 +187,146 @@ def handle_yt_dlp_errors(func):
 
 # Constants
 MAX_FILE_SIZE = 2 * 1000 * 1000 * 1000
-DOWNLOAD_PATH = "downloads/"
+DISK_DOWNLOAD_PATH = "downloads/"
+DOWNLOAD_PATH = DISK_DOWNLOAD_PATH  # Replaced with a RAM-backed directory at startup when available
+TMPFS_MAX_USAGE = 0.5  # Largest share of free RAM-backed space all staged downloads together may take
+TMPFS_PREFIX = 'ytbot-'  # Name prefix of the RAM-backed staging directory, followed by the owner's PID
+tmpfs_reserved = 0  # Expected bytes of downloads currently staged in the RAM-backed directory
 PROGRESS_BAR_LENGTH = 20  # Number of characters in progress bar
+# Every possible progress bar, indexed by the number of filled characters
+_BARS = tuple('█' * i + '░' * (PROGRESS_BAR_LENGTH - i) for i in range(PROGRESS_BAR_LENGTH + 1))
+_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')  # Size units indexed by power of 1024
+PROGRESS_UPDATE_INTERVAL = 3.0  # Minimum seconds between progress message edits
+EXTRACT_TIMEOUT = 30  # Seconds to wait for video info extraction in total
+EXTRACT_HEDGE_DELAY = 10  # Seconds before a slow extraction is hedged with a second attempt
+THUMBNAIL_WAIT_TIMEOUT = 2  # Seconds to wait for a thumbnail before showing the buttons without it
+UPLOAD_EDIT_INTERVAL = 2.0  # Seconds the upload progress pump waits between edits
+PROGRESS_HOOK_INTERVAL_NS = 1_000_000_000  # Minimum nanoseconds between progress callback calls
+MAX_CONCURRENT_DOWNLOADS = 4  # yt-dlp downloads allowed to run at once
+MAX_CONCURRENT_UPLOADS = 8  # Telegram uploads allowed to run at once (Telegram allows ~10 file operations)
+
+# Global limits so bursts of button presses queue instead of thrashing disk and hitting FLOOD_WAIT.
+# Created at startup once uvloop is installed, since older Pythons bind them to the current loop.
+DL_SEM = None
+UPLOAD_SEM = None
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024  # Chunk size for yt-dlp HTTP downloads
+UPLOAD_BUFFER_MAX_SIZE = 4 * 1024 * 1024  # Largest file read into memory before upload; bigger ones upload from disk
+
+# yt-dlp options shared by every call, merged into per-call option dicts
+_BASE_YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'cookiefile': COOKIES_PATH,
+}
+
+# yt-dlp options shared by every download
+_DOWNLOAD_YDL_OPTS = {
+    **_BASE_YDL_OPTS,
+    'concurrent_fragment_downloads': YTDL_CONCURRENT_FRAGMENTS,
+    'http_chunk_size': HTTP_CHUNK_SIZE,
+    'ffmpeg_location': FFMPEG_PATH,
+    'prefer_ffmpeg': True,
+}
+
+
+# Translation table replacing invalid characters for Windows filenames
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
 
 
 def sanitize_filename(filename):
     """Sanitize the filename by removing invalid characters."""
-    # Replace invalid characters for Windows filenames
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
-
-
-# Create downloads directory if it doesn't exist
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
-
-# Create a thread pool executor for running yt-dlp downloads
-thread_pool = ThreadPoolExecutor(max_workers=4)
+    return filename.translate(_SANITIZE_TABLE)
+
+
+# Thread pool for blocking I/O (yt-dlp downloads, file reads and deletes); every blocking
+# call is sent here explicitly, so the event loop's default executor is never used
+IO_POOL_WORKERS = 32
+io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+
+# Process pool for CPU-bound yt-dlp info extraction (signature decryption, JS interpretation),
+# so concurrent extractions are not serialized on the GIL. Created at startup with the spawn
+# start method: forking this multi-threaded process is unsafe, and spawned workers re-import
+# this module, so it must not do anything beyond definitions at import time.
+CPU_POOL_WORKERS = os.cpu_count() or 1
+cpu_pool = None
+# Jobs submitted to cpu_pool that have not finished yet, including cancelled ones still running
+cpu_pool_jobs = 0
+cpu_pool_jobs_lock = threading.Lock()
+
+# Shared HTTP session so thumbnail requests reuse pooled connections (created lazily)
+http_session = None
+HTTP_POOL_SIZE = 16  # Idle keep-alive connections kept for concurrent users
+HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (compatible; YouTubeBot)'}
+
+class TTLCache:
+    """Small LRU cache whose entries expire after a fixed number of seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (timestamp, value)
+
+    def get(self, key):
+        """Return the cached value if it is still fresh, otherwise None."""
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        timestamp, value = entry
+        if time.time() - timestamp >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries."""
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Remove an entry if present."""
+        self._entries.pop(key, None)
+
+
+# Cache of yt-dlp info dicts keyed by video ID
+INFO_CACHE = TTLCache(maxsize=128, ttl=600)
+
+# Cache of (qualities, title) keyed by video ID, so repeated links skip extraction
+EXTRACT_CACHE = TTLCache(maxsize=1024, ttl=600)
+# In-flight extraction tasks keyed by video ID, so concurrent requests for one video share them
+EXTRACT_TASKS = {}
+# Thumbnail download tasks keyed by video ID; failed downloads are evicted so they are retried
+THUMBNAIL_CACHE = TTLCache(maxsize=1024, ttl=600)
+
+# Telegram file IDs of videos already uploaded, so repeated requests skip download and upload.
+# Kept next to the script because the downloads folder is cleared on startup.
+FILE_ID_DB_PATH = os.path.join(SCRIPT_DIR, 'file_ids.db')
+file_id_db = None  # Opened at startup
+# The database is only used from io_pool threads, so its commits never block the event loop
+file_id_db_lock = threading.Lock()
+
+
+def open_file_id_db():
+    """Open the file ID database, creating its table on first use."""
+    global file_id_db
+    file_id_db = sqlite3.connect(FILE_ID_DB_PATH, check_same_thread=False)
+    file_id_db.execute(
+        'CREATE TABLE IF NOT EXISTS file_ids ('
+        'video_id TEXT NOT NULL, format_id TEXT NOT NULL, file_id TEXT NOT NULL, title TEXT, '
+        'PRIMARY KEY (video_id, format_id))'
+    )
+    # Databases created before titles were stored lack the column
+    columns = [row[1] for row in file_id_db.execute('PRAGMA table_info(file_ids)')]
+    if 'title' not in columns:
+        file_id_db.execute('ALTER TABLE file_ids ADD COLUMN title TEXT')
+    file_id_db.commit()
 
-print("🤖 Starting...")
 
-# Print whitelist status
-if WHITELIST_ENABLED:
-    print(f"🔒 Whitelist enabled: {len(WHITELIST)} authorized users")
-else:
-    print("🌐 Public mode: Bot is open to all users")
+# Qualities offered in each sent keyboard: (chat_id, video_id) -> (timestamp, title, qualities)
+PENDING_TTL = 600  # seconds
+PENDING = {}
 
 
 class Progress:
@@ -148,10 +339,11 @@ class Progress:
 
     def make_progress_bar(self, current, total):
         progress = current / total
-        filled_length = int(20 * progress)
-        bar = '█' * filled_length + '░' * (20 - filled_length)
+        filled_length = min(int(PROGRESS_BAR_LENGTH * progress), PROGRESS_BAR_LENGTH)
+        bar = _BARS[filled_length]
         percent = progress * 100
-        speed = current / (time.time() - self.start_time) if hasattr(self, 'start_time') else 0
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        speed = current / elapsed if elapsed else 0
 
         return (
             f"{self.action}...\n"
@@ -162,24 +354,20 @@ class Progress:
 
     @staticmethod
     def format_size(size):
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024:
-                return f"{size:.1f}{unit}"
-            size /= 1024
-        return f"{size:.1f}TB"
+        return format_size(size)
 
     async def update(self, current, total):
-        now = time.time()
+        now = time.monotonic()
 
         # Start time for speed calculation
-        if not hasattr(self, 'start_time'):
+        if self.start_time is None:
             self.start_time = now
 
         current_percent = int((current / total) * 100)
 
-        # Update progress only if percentage changed by at least 5% or if download completed
+        # Update progress at most once per interval or if download completed
         # This helps avoid flood wait limits
-        if (current_percent - self.last_percent >= 5) or current == total:
+        if (now - self.last_update_time >= PROGRESS_UPDATE_INTERVAL) or current == total:
             try:
                 await self.status_message.edit_text(
                     self.make_progress_bar(current, total)
@@ -219,8 +407,8 @@ def should_include_quality(quality_info):
 
 def create_quality_keyboard(qualities, video_url):
     """Create an inline keyboard with quality options."""
-    buttons = []
-    current_row = []
+    # Preallocate rows of 2 buttons each
+    buttons = [[None, None] for _ in range((len(qualities) + 1) // 2)]
     
     # Extract video ID instead of using the full URL
     video_id = extract_video_id(video_url)
@@ -231,7 +419,7 @@ def create_quality_keyboard(qualities, video_url):
         # Use a shortened version of the URL if we can't extract the ID
         video_id = "unknown"
 
-    for quality in qualities:
+    for i, quality in enumerate(qualities):
         # Create button text
         button_text = f"{quality['quality']} ({quality['ext']})"
 
@@ -239,29 +427,24 @@ def create_quality_keyboard(qualities, video_url):
         callback_data = f"dl_{quality['format_id']}_{video_id}"
 
         # Ensure callback data doesn't exceed Telegram's limit (64 bytes)
-        if len(callback_data.encode()) > 64:
+        # Format and video IDs are ASCII, so the string length equals the byte length
+        if len(callback_data) > 64:
             callback_data = f"dl_{quality['format_id']}"  # Just use format ID as last resort
             logging.warning(f"Callback data too large, using shortened version: {callback_data}")
 
-        button = InlineKeyboardButton(
+        row, col = divmod(i, 2)
+        buttons[row][col] = InlineKeyboardButton(
             text=button_text,
             callback_data=callback_data
         )
 
-        current_row.append(button)
-
-        # Create new row after every 2 buttons
-        if len(current_row) == 2:
-            buttons.append(current_row)
-            current_row = []
-
-    # Add any remaining buttons
-    if current_row:
-        buttons.append(current_row)
+    # Trim the unused slot when there is an odd number of buttons
+    if buttons and buttons[-1][-1] is None:
+        buttons[-1].pop()
 
     # Add MP3 download button as the last row
     mp3_callback_data = f"mp3_{video_id}"
-    if len(mp3_callback_data.encode()) > 64:
+    if len(mp3_callback_data) > 64:  # ASCII, so length equals byte length
         mp3_callback_data = "mp3_audio"  # Fallback
     
     mp3_button = InlineKeyboardButton(
@@ -273,21 +456,38 @@ def create_quality_keyboard(qualities, video_url):
     return InlineKeyboardMarkup(buttons)
 
 
+async def acquire_download_slot(status_message):
+    """Wait for a free download slot, telling the user if they are queued."""
+    if DL_SEM.locked():
+        await status_message.edit_text("⏳ Queued, waiting for other downloads to finish...")
+    await DL_SEM.acquire()
+
+
 async def download_and_send_audio(client, callback_query, video_url):
     """Download audio (MP3) and send it to the user."""
     status_message = None
     temp_filepath = None
+    download_slot = False
+    reserved = 0
     loop = asyncio.get_running_loop()
 
     try:
         # Send initial status message
         status_message = await callback_query.message.reply_text("⬇️ Preparing download...")
 
+        last_edit_ts = 0
+
         # Progress handler for download status updates
         async def update_status(current, total):
+            nonlocal last_edit_ts
+            now = time.monotonic()
+            if now - last_edit_ts < PROGRESS_UPDATE_INTERVAL and current != total:
+                return
+            last_edit_ts = now
+
             progress = current / total
-            filled_length = int(PROGRESS_BAR_LENGTH * progress)
-            bar = '█' * filled_length + '░' * (PROGRESS_BAR_LENGTH - filled_length)
+            filled_length = min(int(PROGRESS_BAR_LENGTH * progress), PROGRESS_BAR_LENGTH)
+            bar = _BARS[filled_length]
             percent = progress * 100
 
             try:
@@ -300,15 +500,11 @@ async def download_and_send_audio(client, callback_query, video_url):
 
         # Add download progress callback
         ydl_opts = {
+            **_DOWNLOAD_YDL_OPTS,
             'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
             'progress_hooks': [DownloadProgress(loop, update_status)],
-            'cookiefile': COOKIES_PATH,
             'outtmpl': temp_filepath,
             'filesize_limit': MAX_FILE_SIZE,
-            'ffmpeg_location': FFMPEG_PATH,
-            'prefer_ffmpeg': True,
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'mp3',
@@ -318,10 +514,10 @@ async def download_and_send_audio(client, callback_query, video_url):
 
         # Extract audio information
         await status_message.edit_text("🔄 Retrieving audio information...")
-        info = await extract_info_async(loop, ydl_opts, video_url)
+        info = await cached_extract_info(loop, ydl_opts, video_url)
 
-        # Check file size
-        filesize = info.get('filesize', 0)
+        # Check file size of the selected audio stream
+        filesize = selected_filesize(info)
         if filesize and filesize > MAX_FILE_SIZE:
             await status_message.edit_text("❌ Error: Audio file size exceeds 3.9GB limit!")
             return
@@ -334,22 +530,29 @@ async def download_and_send_audio(client, callback_query, video_url):
         sanitized_title = sanitize_filename(title)
         random_code = uuid.uuid4().hex[:3]  # Generate a short random code
         temp_filename = f"{sanitized_title}_{random_code}.%(ext)s"  # Use dynamic extension
-        temp_filepath = os.path.join(DOWNLOAD_PATH, temp_filename)
+        # The source stream and the converted MP3 (up to 192kbps, often larger) exist together while converting
+        download_dir, reserved = reserve_download_path(filesize, factor=3)
+        temp_filepath = os.path.join(download_dir, temp_filename)
 
         # Update yt-dlp output template
         ydl_opts['outtmpl'] = temp_filepath
 
         # Start the download
+        await acquire_download_slot(status_message)
+        download_slot = True
         await status_message.edit_text("⬇️ Starting download...")
         await download_video_async(loop, ydl_opts, video_url)
+        DL_SEM.release()
+        download_slot = False
         
         # Get the actual downloaded file path with mp3 extension
-        temp_filepath = os.path.join(DOWNLOAD_PATH, f"{sanitized_title}_{random_code}.mp3")
+        temp_filepath = os.path.join(download_dir, f"{sanitized_title}_{random_code}.mp3")
 
-        # Download thumbnail once and reuse it
-        thumbnail_path = None
+        # Reuse the thumbnail fetched when the keyboard was sent, for both the tag and the upload
+        # (shielded, since the cached task may be shared with other requests)
+        thumb_bytes = None
         try:
-            thumbnail_path = download_thumbnail(video_url)
+            thumb_bytes = await asyncio.shield(get_thumbnail_task(extract_video_id(video_url), video_url))
         except Exception as e:
             logging.error(f"Error downloading thumbnail: {str(e)}")
             # Continue without thumbnail if there's an error
@@ -358,39 +561,32 @@ async def download_and_send_audio(client, callback_query, video_url):
         await status_message.edit_text("🎵 Adding metadata...")
         
         try:
-            # First check if file exists
-            if not os.path.exists(temp_filepath):
-                logging.error(f"Cannot add metadata: file {temp_filepath} does not exist")
-            else:
-                # Add ID3 tags - first try to load existing tags or create a new one
-                try:
-                    audio = ID3(temp_filepath)
-                except:
-                    # If no ID3 tag exists, create a new one and save it to the file
-                    audio = ID3()
-                    audio.save(temp_filepath)
-                
-                # Update the tags
-                audio['TIT2'] = TIT2(encoding=3, text=title)  # Song title
-                audio['TPE1'] = TPE1(encoding=3, text=channel_name)  # Artist
-                audio['TALB'] = TALB(encoding=3, text=f"From YouTube")  # Album
-                
-                # Try to add album art if available
-                if thumbnail_path and os.path.exists(thumbnail_path):
-                    with open(thumbnail_path, 'rb') as albumart:
-                        audio['APIC'] = APIC(
-                            encoding=3,
-                            mime='image/jpeg',
-                            type=3,  # Cover image
-                            desc='Cover',
-                            data=albumart.read()
-                        )
-                
-                # Save the ID3 tags to the file
-                audio.save(temp_filepath)
-                
-                logging.info(f"Added metadata: Title={title}, Artist={channel_name}")
-                
+            # Load the MP3 and create an ID3 tag in memory if it has none
+            # (a missing file raises here and is logged below)
+            audio = MP3(temp_filepath, ID3=ID3)
+            if audio.tags is None:
+                audio.add_tags()
+            
+            # Update the tags
+            audio.tags.add(TIT2(encoding=3, text=title))  # Song title
+            audio.tags.add(TPE1(encoding=3, text=channel_name))  # Artist
+            audio.tags.add(TALB(encoding=3, text="From YouTube"))  # Album
+            
+            # Try to add album art if available
+            if thumb_bytes:
+                audio.tags.add(APIC(
+                    encoding=3,
+                    mime='image/jpeg',
+                    type=3,  # Cover image
+                    desc='Cover',
+                    data=thumb_bytes
+                ))
+            
+            # Write the ID3 tags to the file in a single save
+            audio.save()
+            
+            logging.info(f"Added metadata: Title={title}, Artist={channel_name}")
+            
         except Exception as e:
             logging.error(f"Error adding metadata: {str(e)}")
             # Continue even if metadata addition fails
@@ -398,27 +594,29 @@ async def download_and_send_audio(client, callback_query, video_url):
         # Update status for upload
         await status_message.edit_text("⬆️ Uploading audio to Telegram...")
 
+        # Upload the in-memory thumbnail directly instead of writing it to disk
+        thumb = None
+        if thumb_bytes:
+            thumb = io.BytesIO(thumb_bytes)
+            thumb.name = "thumbnail.jpg"
+
+        # Read a small MP3 in a worker thread so Pyrogram's chunked reads don't block the event loop
+        audio_file = await load_file_async(loop, temp_filepath)
+
         # Send the MP3 file to the user with appropriate metadata
-        await client.send_audio(
-            chat_id=callback_query.message.chat.id,
-            audio=temp_filepath,
-            title=title,
-            performer=channel_name,
-            thumb=thumbnail_path,  # Use the already downloaded thumbnail
-            caption=f"🎶 {title} - {channel_name}"
-        )
+        async with UPLOAD_SEM:
+            await client.send_audio(
+                chat_id=callback_query.message.chat.id,
+                audio=audio_file,
+                file_name=os.path.basename(temp_filepath),
+                title=title,
+                performer=channel_name,
+                thumb=thumb,  # Use the already downloaded thumbnail
+                caption=f"🎶 {title} - {channel_name}"
+            )
 
-        # Clean up the downloaded file and thumbnail
-        if os.path.exists(temp_filepath):
-            os.remove(temp_filepath)
-        
-        # Clean up thumbnail file
-        if thumbnail_path and os.path.exists(thumbnail_path):
-            try:
-                os.remove(thumbnail_path)
-                logging.debug(f"Removed thumbnail: {thumbnail_path}")
-            except Exception as e:
-                logging.error(f"Error removing thumbnail: {str(e)}")
+        # Clean up the downloaded file
+        await remove_file_async(loop, temp_filepath)
 
         # Delete the status message
         await status_message.delete()
@@ -429,20 +627,116 @@ async def download_and_send_audio(client, callback_query, video_url):
             await status_message.edit_text(error_message)
 
         # Clean up in case of error
-        if temp_filepath and os.path.exists(temp_filepath):
-            os.remove(temp_filepath)
+        if temp_filepath:
+            await remove_file_async(loop, temp_filepath)
+
+    finally:
+        if download_slot:
+            DL_SEM.release()
+        release_download_path(reserved)
+
+
+def is_stale_staging_dir(path):
+    """Return True if a RAM-backed staging directory belongs to a process that is no longer running."""
+    pid, _, _ = os.path.basename(path)[len(TMPFS_PREFIX):].partition('-')
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # Running as another user
+    return False
+
+
+def setup_download_path():
+    """Stage downloads in RAM (/dev/shm) when available so they never touch the disk."""
+    global DOWNLOAD_PATH
+    if not os.path.isdir('/dev/shm'):
+        return
+    # A crash or OOM kill skips the atexit cleanup, and the leftover files hold RAM until reboot.
+    # /dev/shm is shared by the whole host, so only directories of dead bot processes are removed.
+    for staging_path in glob.glob(os.path.join('/dev/shm', TMPFS_PREFIX + '*')):
+        if is_stale_staging_dir(staging_path):
+            shutil.rmtree(staging_path, ignore_errors=True)
+    DOWNLOAD_PATH = tempfile.mkdtemp(prefix=f'{TMPFS_PREFIX}{os.getpid()}-', dir='/dev/shm')
+    atexit.register(shutil.rmtree, DOWNLOAD_PATH, ignore_errors=True)
+
+
+def reserve_download_path(expected_size, factor=1):
+    """Return (directory, reserved bytes) for a download.
+
+    Picks the RAM-backed staging directory if factor times the expected size (which
+    may be None if unknown) fits alongside every download already staged there,
+    reserving that much; otherwise the disk folder.
+    """
+    global tmpfs_reserved
+    if DOWNLOAD_PATH == DISK_DOWNLOAD_PATH or not expected_size:
+        return DISK_DOWNLOAD_PATH, 0
+    expected_size *= factor
+    try:
+        free = shutil.disk_usage(DOWNLOAD_PATH).free
+    except OSError:
+        return DISK_DOWNLOAD_PATH, 0
+    if tmpfs_reserved + expected_size > free * TMPFS_MAX_USAGE:
+        return DISK_DOWNLOAD_PATH, 0
+    tmpfs_reserved += expected_size
+    return DOWNLOAD_PATH, expected_size
+
+
+def release_download_path(reserved):
+    """Release space reserved by reserve_download_path once the staged file is gone."""
+    global tmpfs_reserved
+    tmpfs_reserved -= reserved
 
 
 def clear_downloads_folder():
     """Clear the downloads folder at startup."""
     downloads_folder = "downloads"
-    if os.path.exists(downloads_folder):
-        shutil.rmtree(downloads_folder)
+    shutil.rmtree(downloads_folder, ignore_errors=True)
     os.makedirs(downloads_folder, exist_ok=True)
 
 
+def best_audio_format(formats):
+    """Return the audio-only format with the highest bitrate, or None."""
+    audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
+    return max(audio_formats, key=lambda f: f.get('abr') or 0, default=None)
+
+
+def format_filesize(f):
+    """Return the exact or approximate size of a single format, or 0 if unknown."""
+    return f.get('filesize') or f.get('filesize_approx') or 0
+
+
+def selected_filesize(info, format_id=None):
+    """Estimate the download size of a format from the formats listed in an info dict.
+
+    Cached info may come from a different format selection, so its top-level size
+    can't be trusted. Video-only formats include the best audio stream they are
+    merged with; without a format ID the best audio stream alone is used.
+    """
+    formats = info.get('formats') or []
+    best_audio = best_audio_format(formats)
+    best_audio_size = format_filesize(best_audio) if best_audio else 0
+    if format_id is None:
+        return best_audio_size
+
+    for f in formats:
+        if f.get('format_id') == format_id:
+            size = format_filesize(f)
+            if size and f.get('acodec') == 'none':
+                size += best_audio_size
+            return size
+    return 0
+
+
 def get_video_qualities(url):
-    """Extract available video qualities from YouTube URL."""
+    """Extract available video qualities from YouTube URL.
+
+    Runs inside a worker process, so it returns the sanitized info dict for the
+    caller to cache alongside the qualities and title (or error message).
+    """
     logging.info(f"Starting quality extraction for URL: {url}")
     
     # Try up to 3 times in case of network errors
@@ -452,21 +746,20 @@ def get_video_qualities(url):
     for attempt in range(max_retries):
         try:
             ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
+                **_BASE_YDL_OPTS,
                 'extract_flat': False,
                 'cookiefile': COOKIES_PATH if os.path.exists(COOKIES_PATH) else None,
                 'nocheckcertificate': True,
                 'socket_timeout': 15,  # Increase timeout for slow connections
             }
 
-            logging.debug(f"YDL options: {ydl_opts}")
+            logging.debug("YDL options: %r", ydl_opts)
 
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 logging.info(f"Starting info extraction (attempt {attempt+1}/{max_retries})")
                 try:
                     info = ydl.extract_info(url, download=False)
-                    logging.debug(f"Raw info: {info}")
+                    logging.debug("Raw info: %r", info)
                 except yt_dlp.utils.DownloadError as e:
                     error_msg = str(e)
                     if 'getaddrinfo failed' in error_msg or 'Unable to download webpage' in error_msg:
@@ -475,37 +768,31 @@ def get_video_qualities(url):
                             time.sleep(retry_delay)
                             continue
                     logging.error(f"Error during info extraction: {error_msg}", exc_info=True)
-                    return None, f"Info extraction failed: {error_msg}"
+                    return None, f"Info extraction failed: {error_msg}", None
                 except Exception as e:
                     logging.error(f"Error during info extraction: {str(e)}", exc_info=True)
-                    return None, f"Info extraction failed: {str(e)}"
+                    return None, f"Info extraction failed: {str(e)}", None
 
                 if not info:
                     logging.error("No info returned from yt-dlp")
-                    return None, "Could not extract video information"
+                    return None, "Could not extract video information", None
 
                 formats = info.get('formats', [])
                 logging.info(f"Found {len(formats)} formats")
 
                 if not formats:
                     logging.error("No formats found in video info")
-                    return None, "No available formats found"
+                    return None, "No available formats found", None
 
                 # Find the best audio stream to estimate combined file sizes
-                audio_formats = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-                best_audio = None
-                if audio_formats:
-                    best_audio = max(audio_formats, key=lambda f: f.get('abr') or 0, default=None)
-                
-                best_audio_size = 0
-                if best_audio:
-                    best_audio_size = best_audio.get('filesize') or best_audio.get('filesize_approx') or 0
+                best_audio = best_audio_format(formats)
+                best_audio_size = format_filesize(best_audio) if best_audio else 0
 
                 qualities = []
                 seen_qualities = set()
 
                 for f in formats:
-                    logging.debug(f"Processing format: {f}")
+                    logging.debug("Processing format: %r", f)
                     # Only include video formats with video codec
                     if f.get('vcodec') != 'none':
                         quality = f.get('format_note', f.get('height', 'N/A'))
@@ -539,7 +826,7 @@ def get_video_qualities(url):
                                 'fps': f.get('fps')
                             }
 
-                            logging.debug(f"Quality info: {quality_info}")
+                            logging.debug("Quality info: %r", quality_info)
 
                             if should_include_quality(quality_info):
                                 qualities.append(quality_info)
@@ -547,10 +834,13 @@ def get_video_qualities(url):
 
                 if not qualities:
                     logging.error("No suitable qualities found after filtering")
-                    return None, "No suitable video qualities found"
+                    return None, "No suitable video qualities found", None
+
+                # Sort once here (highest resolution first) so the keyboard builder doesn't have to
+                qualities.sort(key=lambda q: (-(q['height'] or 0), q['fps'] or 0))
 
                 logging.info(f"Successfully extracted {len(qualities)} qualities")
-                return qualities, info.get('title', 'Unknown Title')
+                return qualities, info.get('title', 'Unknown Title'), ydl.sanitize_info(info)
                 
             # If we get here without returning, we need to retry
             logging.warning(f"Extraction attempt {attempt+1} failed without specific error, retrying...")
@@ -561,82 +851,71 @@ def get_video_qualities(url):
                 time.sleep(retry_delay)
             else:
                 logging.error(f"Unexpected error in get_video_qualities: {str(e)}", exc_info=True)
-                return None, str(e)
+                return None, str(e), None
     
     # If we've exhausted all retries
-    return None, "Failed to extract video info after multiple attempts. Please check your internet connection and try again."
+    return None, "Failed to extract video info after multiple attempts. Please check your internet connection and try again.", None
+
+
+# Matches the video ID in every supported YouTube URL shape in a single pass
+_YT_ID_RE = re.compile(
+    r'(?:youtu\.be/|/shorts/|/embed/|/live/|[?&]v=|/watch/|videoId["\':=]+)'
+    r'([A-Za-z0-9_-]{6,})'
+)
 
 
 def extract_video_id(url: str) -> str:
     """Extract video ID from both youtube.com and youtu.be URLs."""
-    # Normalize the URL to handle URLs without "www."
-    url = url.strip()
-    logging.debug(f"Extracting video ID from URL: {url}")
-    
-    if "youtu.be" in url:
-        # Handle youtu.be/VIDEO_ID format
-        video_id = url.split("youtu.be/")[-1].split("?")[0].split("&")[0]
-        logging.debug(f"Extracted video ID from youtu.be URL: {video_id}")
-    else:
-        # Handle YouTube Shorts format
-        if "/shorts/" in url:
-            video_id = url.split("/shorts/")[-1].split("?")[0].split("&")[0]
-            logging.debug(f"Extracted video ID from YouTube Shorts URL: {video_id}")
-        # Handle music.youtube.com format
-        elif "music.youtube.com" in url:
-            if "v=" in url:
-                video_id = url.split("v=")[-1].split("&")[0]
-                logging.debug(f"Extracted video ID from music.youtube.com URL with v= parameter: {video_id}")
-            elif "watch/" in url:
-                video_id = url.split("watch/")[-1].split("?")[0].split("&")[0]
-                logging.debug(f"Extracted video ID from music.youtube.com/watch/ format: {video_id}")
-            else:
-                # Try to find videoId in other formats
-                match = re.search(r'videoId[=:]["\']?([^"\'&]+)', url)
-                if match:
-                    video_id = match.group(1)
-                    logging.debug(f"Extracted video ID using regex from music.youtube.com: {video_id}")
-                else:
-                    video_id = ""
-                    logging.warning(f"Could not extract video ID from music.youtube.com URL: {url}")
-        # Handle regular youtube.com format
-        elif "v=" in url:
-            video_id = url.split("v=")[-1].split("&")[0]
-            logging.debug(f"Extracted video ID from youtube.com URL with v= parameter: {video_id}")
-        else:
-            # Handle other potential youtube.com formats
-            # First, normalize the URL to ensure consistent handling
-            if "youtube.com" in url:
-                path_part = url.split("youtube.com/")[-1]
-                logging.debug(f"Path part after youtube.com/: {path_part}")
-                path = path_part.split("?")[0].split("&")[0]
-                if path.startswith("watch/"):
-                    video_id = path.split("watch/")[-1]
-                    logging.debug(f"Extracted video ID from youtube.com/watch/ format: {video_id}")
-                elif path.startswith("embed/"):
-                    video_id = path.split("embed/")[-1]
-                    logging.debug(f"Extracted video ID from youtube.com/embed/ format: {video_id}")
-                else:
-                    video_id = path
-                    logging.debug(f"Using path as video ID: {video_id}")
-            else:
-                # Fallback for unexpected URL formats
-                video_id = ""
-                logging.warning(f"Could not extract video ID from URL: {url}")
+    match = _YT_ID_RE.search(url.strip())
+    if not match:
+        logging.warning("Could not extract video ID from URL: %s", url)
+        return ""
+
+    video_id = match.group(1)
+    logging.debug("Extracted video ID %s from URL: %s", video_id, url)
+    return video_id
+
+
+async def get_http_session():
+    """Return the shared aiohttp session, creating it on first use."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_SIZE),
+            headers=HTTP_HEADERS
+        )
+    return http_session
 
-    return video_id.strip()
 
+async def close_http_session():
+    """Close the shared aiohttp session if it was ever created."""
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
 
-def download_thumbnail(video_url: str) -> str:
-    """Download the thumbnail of a YouTube video with fallbacks."""
+
+async def probe_thumbnail(thumbnail_url: str) -> bool:
+    """Check with a HEAD request whether a thumbnail exists and is not a placeholder."""
+    try:
+        session = await get_http_session()
+        async with session.head(
+            thumbnail_url, timeout=aiohttp.ClientTimeout(total=5), allow_redirects=True
+        ) as response:
+            return response.status == 200 and (response.content_length or 0) > 1000
+    except Exception as e:
+        logging.debug("Failed to probe thumbnail %s: %s", thumbnail_url, e)
+        return False
+
+
+async def fetch_thumbnail_bytes(video_url: str) -> bytes:
+    """Fetch the thumbnail of a YouTube video into memory with fallbacks."""
     # Extract video ID using the helper function
     try:
         video_id = extract_video_id(video_url)
-        logging.info(f"Extracted video ID: {video_id}")
+        logging.info("Extracted video ID: %s", video_id)
         
         # If video_id is empty, return None
         if not video_id:
-            logging.error(f"Failed to extract video ID from URL: {video_url}")
+            logging.error("Failed to extract video ID from URL: %s", video_url)
             return None
 
         # Try different thumbnail qualities in order
@@ -648,26 +927,32 @@ def download_thumbnail(video_url: str) -> str:
             'default.jpg'  # 120x90
         ]
 
-        for quality in thumbnail_qualities:
-            thumbnail_url = f"https://img.youtube.com/vi/{video_id}/{quality}"
+        thumbnail_urls = [f"https://img.youtube.com/vi/{video_id}/{quality}" for quality in thumbnail_qualities]
+
+        # Probe all qualities in parallel so the worst case is a single round-trip
+        probes = await asyncio.gather(*(probe_thumbnail(url) for url in thumbnail_urls))
+        session = await get_http_session()
+
+        for quality, thumbnail_url, available in zip(thumbnail_qualities, thumbnail_urls, probes):
+            if not available:
+                continue
             try:
-                response = requests.get(thumbnail_url, stream=True, timeout=10)
-                if response.status_code == 200 and int(response.headers.get('content-length', 0)) > 1000:
-                    thumbnail_path = f"thumbnail_{video_id}.jpg"
-                    with open(thumbnail_path, "wb") as file:
-                        for chunk in response.iter_content(1024):
-                            file.write(chunk)
-                    logging.info(f"Successfully downloaded thumbnail: {quality}")
-                    return thumbnail_path
+                async with session.get(thumbnail_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status == 200:
+                        buffer = io.BytesIO()
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            buffer.write(chunk)
+                        logging.info("Successfully downloaded thumbnail: %s", quality)
+                        return buffer.getvalue()
             except Exception as e:
-                logging.debug(f"Failed to download {quality} thumbnail: {str(e)}")
+                logging.debug("Failed to download %s thumbnail: %s", quality, e)
                 continue
 
         logging.warning("All thumbnail download attempts failed")
         return None
 
     except Exception as e:
-        logging.error(f"Error in download_thumbnail: {str(e)}")
+        logging.error("Error in fetch_thumbnail_bytes: %s", e)
         return None
 
 
@@ -676,6 +961,10 @@ class DownloadProgress:
         self.loop = loop
         self.progress_callback = progress_callback
         self.last_update_time = 0
+        self._pending = False
+
+    def _done(self, _future):
+        self._pending = False
 
     def __call__(self, d):
         if d['status'] == 'downloading':
@@ -683,58 +972,197 @@ class DownloadProgress:
             downloaded_bytes = d.get('downloaded_bytes', 0)
 
             if total_bytes:
-                now = time.time()
+                now = time.monotonic_ns()
 
                 # Update every 1 second
-                if now - self.last_update_time >= 1:
+                if now - self.last_update_time >= PROGRESS_HOOK_INTERVAL_NS:
+                    # Skip this tick if the previous edit is still in flight
+                    if self._pending:
+                        return
+                    self._pending = True
+
+                    # Schedule the update without blocking the download thread
                     future = asyncio.run_coroutine_threadsafe(
                         self.progress_callback(downloaded_bytes, total_bytes),
                         self.loop
                     )
-                    # Wait for the future to complete to ensure the message is sent
-                    try:
-                        future.result(timeout=5)
-                    except Exception:
-                        pass
+                    future.add_done_callback(self._done)
                     self.last_update_time = now
 
 
+def download_video(ydl_opts, url):
+    """Run a yt-dlp download; YoutubeDL holds mutable state so one is created per call"""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.download([url])
+
+
 async def download_video_async(loop, ydl_opts, url):
     """Run yt-dlp download in a separate thread"""
+    return await loop.run_in_executor(io_pool, download_video, ydl_opts, url)
+
+
+def remove_file(path):
+    """Remove a file, ignoring it if it is already gone"""
+    pathlib.Path(path).unlink(missing_ok=True)
+
+
+async def remove_file_async(loop, path):
+    """Remove a file in a separate thread so the event loop never blocks on unlink"""
+    return await loop.run_in_executor(io_pool, remove_file, path)
+
+
+def load_file(path):
+    """Read a small file into a named in-memory buffer suitable for Pyrogram uploads.
+
+    Larger files are returned as their path so concurrent uploads don't each hold a copy in memory.
+    """
+    if os.path.getsize(path) > UPLOAD_BUFFER_MAX_SIZE:
+        return path
+    with open(path, 'rb') as f:
+        buffer = io.BytesIO(f.read())
+    buffer.name = os.path.basename(path)
+    return buffer
+
 
-    def download():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.download([url])
+async def load_file_async(loop, path):
+    """Read a small file into memory in a separate thread"""
+    return await loop.run_in_executor(io_pool, load_file, path)
 
-    return await loop.run_in_executor(thread_pool, download)
+
+def extract_info(ydl_opts, url):
+    """Extract video info; runs inside a worker process so it must stay module-level"""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Sanitize so the info dict can be pickled back to the parent process
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+
+def _cpu_pool_job_done(_future):
+    global cpu_pool_jobs
+    with cpu_pool_jobs_lock:
+        cpu_pool_jobs -= 1
+
+
+def run_in_cpu_pool(loop, func, *args):
+    """Run a function in the process pool, counting it until its worker is free again.
+
+    Cancelling the returned future only drops a job that hasn't started yet; a running
+    job keeps its worker busy until it finishes, so it stays counted until then.
+    """
+    global cpu_pool_jobs
+    with cpu_pool_jobs_lock:
+        cpu_pool_jobs += 1
+    future = cpu_pool.submit(func, *args)
+    future.add_done_callback(_cpu_pool_job_done)
+    return asyncio.wrap_future(future, loop=loop)
+
+
+def cpu_pool_has_idle_worker():
+    """Return True if a process pool job would start right away instead of queueing."""
+    return cpu_pool_jobs < CPU_POOL_WORKERS
 
 
 async def extract_info_async(loop, ydl_opts, url):
-    """Extract video info in a separate thread"""
+    """Extract video info in a separate process"""
+    # Progress hooks hold references to the event loop and cannot be pickled
+    ydl_opts = {key: value for key, value in ydl_opts.items() if key != 'progress_hooks'}
+    return await run_in_cpu_pool(loop, extract_info, ydl_opts, url)
+
+
+def remember_pending(chat_id, video_id, title, qualities):
+    """Remember the qualities offered to a chat so a selection needs no re-extraction."""
+    now = time.time()
+    for key in [key for key, (timestamp, _, _) in PENDING.items() if now - timestamp >= PENDING_TTL]:
+        del PENDING[key]
+    if video_id:
+        PENDING[(chat_id, video_id)] = (now, title, qualities)
+
+
+def lookup_pending(chat_id, video_id, format_id):
+    """Return (title, filesize) for a previously offered format, or None if unknown or expired."""
+    entry = PENDING.get((chat_id, video_id))
+    if not entry:
+        return None
+    timestamp, title, qualities = entry
+    if time.time() - timestamp >= PENDING_TTL:
+        del PENDING[(chat_id, video_id)]
+        return None
+    for quality in qualities:
+        if quality['format_id'] == format_id:
+            return title, quality['filesize']
+    return None
+
+
+def get_cached_file_id(video_id, format_id):
+    """Return (file ID, title) of a previously uploaded video, or None."""
+    with file_id_db_lock:
+        row = file_id_db.execute(
+            'SELECT file_id, title FROM file_ids WHERE video_id = ? AND format_id = ? AND title IS NOT NULL',
+            (video_id, format_id)
+        ).fetchone()
+    return row
+
+
+def store_file_id(video_id, format_id, file_id, title):
+    """Remember the Telegram file ID and title of an uploaded video."""
+    with file_id_db_lock:
+        file_id_db.execute(
+            'INSERT OR REPLACE INTO file_ids (video_id, format_id, file_id, title) VALUES (?, ?, ?, ?)',
+            (video_id, format_id, file_id, title)
+        )
+        file_id_db.commit()
+
+
+def forget_file_id(video_id, format_id):
+    """Drop a stored Telegram file ID that is no longer valid."""
+    with file_id_db_lock:
+        file_id_db.execute('DELETE FROM file_ids WHERE video_id = ? AND format_id = ?', (video_id, format_id))
+        file_id_db.commit()
 
-    def extract():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            return ydl.extract_info(url, download=False)
 
-    return await loop.run_in_executor(thread_pool, extract)
+async def cached_extract_info(loop, ydl_opts, url):
+    """Return cached video info if available, falling back to a real extraction"""
+    video_id = extract_video_id(url)
+    info = INFO_CACHE.get(video_id)
+    if info is not None:
+        logging.debug("Using cached info for video ID: %s", video_id)
+        return info
+
+    info = await extract_info_async(loop, ydl_opts, url)
+    if info and video_id:
+        INFO_CACHE.set(video_id, info)
+    return info
+
+
+def video_format_selector(format_id):
+    """Prefer M4A audio so merging with an MP4 video stream is a plain remux."""
+    return f'{format_id}+ba[ext=m4a]/{format_id}+bestaudio/best[ext=mp4]/best'
 
 
 async def download_and_send_video(client, callback_query, format_id, video_url):
     """Download video and send it to user."""
     status_message = None
-    temp_filepath = None
     final_filepath = None
+    download_slot = False
+    reserved = 0
     loop = asyncio.get_running_loop()
 
     try:
         # Send initial status message
         status_message = await callback_query.message.reply_text("⬇️ Preparing download...")
 
+        last_edit_ts = 0
+
         # Progress handler for download status updates
         async def update_status(current, total):
+            nonlocal last_edit_ts
+            now = time.monotonic()
+            if now - last_edit_ts < PROGRESS_UPDATE_INTERVAL and current != total:
+                return
+            last_edit_ts = now
+
             progress = current / total if total else 0
-            filled_length = int(20 * progress)
-            bar = '█' * filled_length + '░' * (20 - filled_length)
+            filled_length = min(int(PROGRESS_BAR_LENGTH * progress), PROGRESS_BAR_LENGTH)
+            bar = _BARS[filled_length]
             percent = progress * 100
 
             try:
@@ -745,18 +1173,43 @@ async def download_and_send_video(client, callback_query, format_id, video_url):
             except Exception:
                 pass
 
-        # Step 1: Extract video metadata for pre-check and accurate file size
-        ydl_opts_info = {
-            'format': f'{format_id}+bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'cookiefile': COOKIES_PATH
-        }
+        chat_id = callback_query.message.chat.id
+        video_id = extract_video_id(video_url)
+
+        # Resend a previous upload of the same video and format without extracting or downloading again
+        cached = await loop.run_in_executor(io_pool, get_cached_file_id, video_id, format_id) if video_id else None
+        if cached:
+            file_id, title = cached
+            try:
+                await client.send_video(
+                    chat_id=chat_id,
+                    video=file_id,
+                    caption=f"📹 {title}"
+                )
+                await status_message.delete()
+                return
+            except Exception as e:
+                logging.info("Could not resend stored file ID for %s (%s), uploading again: %s",
+                             video_id, format_id, e)
+                await loop.run_in_executor(io_pool, forget_file_id, video_id, format_id)
+
+        # Step 1: Use the title and size computed when the keyboard was sent,
+        # falling back to extracting video metadata if the entry has expired
+        pending = lookup_pending(chat_id, video_id, format_id)
+
+        if pending:
+            title, filesize = pending
+        else:
+            ydl_opts_info = {
+                **_BASE_YDL_OPTS,
+                'format': video_format_selector(format_id),
+            }
 
-        info = await extract_info_async(loop, ydl_opts_info, video_url)
+            info = await cached_extract_info(loop, ydl_opts_info, video_url)
+            title = info.get('title', 'video')
+            filesize = selected_filesize(info, format_id)
 
         # Step 2: Check file size before downloading
-        filesize = info.get('filesize') or info.get('filesize_approx', 0)
 
         if filesize and filesize > MAX_FILE_SIZE:
             await status_message.edit_text(
@@ -765,75 +1218,106 @@ async def download_and_send_video(client, callback_query, format_id, video_url):
             return
 
         # Step 3: Prepare filenames and paths
-        title = info.get('title', 'video')
         sanitized_title = sanitize_filename(title)
         unique_id = uuid.uuid4().hex
-        temp_filename = f"{unique_id}.mp4"
         final_filename = f"{sanitized_title}_{unique_id}.mp4"
-        temp_filepath = os.path.join(DOWNLOAD_PATH, temp_filename)
-        final_filepath = os.path.join(DOWNLOAD_PATH, final_filename)
+        # The separate video and audio streams exist alongside the merged file while merging
+        download_dir, reserved = reserve_download_path(filesize, factor=2)
+        final_filepath = os.path.join(download_dir, final_filename)
 
         # Step 4: Configure yt-dlp for downloading
         ydl_opts = {
-            'format': f'{format_id}+bestaudio/best',  # Ensure audio is included
-            'outtmpl': temp_filepath,
-            'quiet': True,
-            'no_warnings': True,
+            **_DOWNLOAD_YDL_OPTS,
+            'format': video_format_selector(format_id),  # Ensure audio is included
+            'outtmpl': final_filepath.replace('%', '%%'),  # Write straight to the final name
             'no_progress': True,
             'progress_hooks': [DownloadProgress(loop, update_status)],
-            'cookiefile': COOKIES_PATH,
-            'ffmpeg_location': FFMPEG_PATH,
-            'prefer_ffmpeg': True,
-            'merge_output_format': 'mp4'  # Force output as MP4
+            'retries': 3,
+            'fragment_retries': 10,
+            'merge_output_format': 'mp4',  # Force output as MP4 (yt-dlp's ffmpeg calls already add -movflags +faststart)
         }
 
-        # Step 5: Start the download
+        # Let aria2c split the download across many connections if available,
+        # otherwise keep yt-dlp's native downloader
+        if ARIA2C_PATH:
+            ydl_opts['external_downloader'] = ARIA2C_PATH
+            ydl_opts['external_downloader_args'] = ['-x', '16', '-s', '16', '-k', '1M']
+
+        # Step 5: Start the download once a download slot is free
+        await acquire_download_slot(status_message)
+        download_slot = True
         await status_message.edit_text("⬇️ Starting download...")
         await download_video_async(loop, ydl_opts, video_url)
-
-        # Rename the downloaded file to the final filename
-        if os.path.exists(temp_filepath):
-            os.rename(temp_filepath, final_filepath)
+        DL_SEM.release()
+        download_slot = False
 
         # Step 6: Prepare for upload
         await status_message.edit_text("⬆️ Uploading to Telegram...")
 
-        last_upload_update = time.time()
+        last_upload_update = time.monotonic_ns()
+
+        # Latest upload progress text, drained by a single background pump so the
+        # upload coroutine never waits on an edit and stale updates are dropped
+        progress_state = {'text': None}
+        progress_event = asyncio.Event()
+
+        async def progress_pump():
+            while True:
+                await progress_event.wait()
+                await asyncio.sleep(UPLOAD_EDIT_INTERVAL)
+                text = progress_state['text']
+                progress_event.clear()
+                try:
+                    await status_message.edit_text(text)
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except Exception:
+                    pass
 
         async def upload_progress(current, total):
             nonlocal last_upload_update
-            now = time.time()
+            now = time.monotonic_ns()
 
-            if now - last_upload_update >= 1:
+            if now - last_upload_update >= PROGRESS_HOOK_INTERVAL_NS:
                 progress = current / total if total else 0
-                filled_length = int(20 * progress)
-                bar = '█' * filled_length + '░' * (20 - filled_length)
+                filled_length = min(int(PROGRESS_BAR_LENGTH * progress), PROGRESS_BAR_LENGTH)
+                bar = _BARS[filled_length]
                 percent = progress * 100
 
                 size_current = format_size(current)
                 size_total = format_size(total)
 
-                try:
-                    await status_message.edit_text(
-                        f"⬆️ Uploading to Telegram...\n"
-                        f"{bar} {percent:.1f}%\n"
-                        f"{size_current}/{size_total}"
-                    )
-                    last_upload_update = now
-                except Exception:
-                    pass
+                progress_state['text'] = (
+                    f"⬆️ Uploading to Telegram...\n"
+                    f"{bar} {percent:.1f}%\n"
+                    f"{size_current}/{size_total}"
+                )
+                progress_event.set()
+                last_upload_update = now
 
         # Step 7: Upload video to Telegram
-        await client.send_video(
-            chat_id=callback_query.message.chat.id,
-            video=final_filepath,
-            caption=f"📹 {title}",
-            progress=upload_progress
-        )
+        # The path is passed as-is: MTProto encrypts every uploaded part in user space,
+        # so sendfile/splice zero-copy can't apply and Pyrogram's own chunked reads are used
+        pump_task = asyncio.create_task(progress_pump())
+        try:
+            async with UPLOAD_SEM:
+                sent_message = await client.send_video(
+                    chat_id=callback_query.message.chat.id,
+                    video=final_filepath,
+                    caption=f"📹 {title}",
+                    progress=upload_progress
+                )
+        finally:
+            pump_task.cancel()
+
+        if video_id and sent_message and sent_message.video:
+            await loop.run_in_executor(
+                io_pool, store_file_id, video_id, format_id, sent_message.video.file_id, title
+            )
 
         # Step 8: Clean up
-        if os.path.exists(final_filepath):
-            os.remove(final_filepath)
+        PENDING.pop((chat_id, video_id), None)
+        await remove_file_async(loop, final_filepath)
 
         await status_message.delete()
 
@@ -845,22 +1329,24 @@ async def download_and_send_video(client, callback_query, format_id, video_url):
             await callback_query.message.reply_text(error_message)
 
         # Clean up in case of error
-        if temp_filepath and os.path.exists(temp_filepath):
-            os.remove(temp_filepath)
-        if final_filepath and os.path.exists(final_filepath):
-            os.remove(final_filepath)
+        if final_filepath:
+            await remove_file_async(loop, final_filepath)
+
+    finally:
+        if download_slot:
+            DL_SEM.release()
+        release_download_path(reserved)
 
 
 def format_size(size):
     """Format size in bytes to human-readable format"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size < 1024:
-            return f"{size:.1f}{unit}"
-        size /= 1024
-    return f"{size:.1f}TB"
+    if size < 1024:
+        return f"{size:.1f}B"
+    # Each unit step is 10 bits, so the bit length picks the unit directly
+    idx = min((int(size).bit_length() - 1) // 10, 4)
+    return f"{size / (1 << (idx * 10)):.1f}{_UNITS[idx]}"
 
 
-@app.on_message(filters.command("start"))
 async def start_command(client, message):
     """Handle /start command."""
     if not is_user_allowed(message.from_user.id):
@@ -873,6 +1359,13 @@ async def start_command(client, message):
     await message.reply_text(welcome_text)
 
 
+# Matches messages containing a YouTube link; shared by the link and invalid-input handlers
+YT_RE = re.compile(r'(https?://)?(www\.)?(youtube\.com|youtu\.be|music\.youtube\.com)/.*')
+
+# youtube.com URLs (after adding the protocol) that still need the www. prefix
+_BARE_YOUTUBE_PREFIXES = ('https://youtube.com', 'http://youtube.com')
+
+
 def normalize_youtube_url(url: str) -> str:
     """Normalize YouTube URL to ensure consistent processing."""
     url = url.strip()
@@ -885,81 +1378,165 @@ def normalize_youtube_url(url: str) -> str:
         url = 'https://' + url
     
     # Add www. if it's youtube.com without www.
-    if 'youtube.com' in url and 'www.youtube.com' not in url and 'music.youtube.com' not in url:
-        url = url.replace('youtube.com', 'www.youtube.com')
+    if url.startswith(_BARE_YOUTUBE_PREFIXES):
+        url = url.replace('youtube.com', 'www.youtube.com', 1)
     
     # Convert YouTube Shorts URL to regular watch URL
-    if '/shorts/' in url:
-        video_id = url.split('/shorts/')[1].split('?')[0]
+    _, shorts, tail = url.partition('/shorts/')
+    if shorts:
+        video_id = tail.partition('?')[0]
         url = f'https://www.youtube.com/watch?v={video_id}'
     
-    logging.info(f"Normalized URL: {url}")
+    logging.info("Normalized URL: %s", url)
     return url
 
 
-@app.on_message(filters.regex(r'(https?://)?(www\.)?(youtube\.com|youtu\.be|music\.youtube\.com)/.*'))
+async def extract_video_qualities(loop, url):
+    """Extract video qualities, returning (qualities, title) or (None, error message).
+
+    Starts one extraction and, if it is still running after EXTRACT_HEDGE_DELAY and a
+    process worker is idle, hedges with a second, taking whichever succeeds first.
+    A failed attempt is not retried, since extraction errors are deterministic.
+    """
+    qualities = None
+    title = None
+    last_error = None
+
+    # Run the CPU-heavy extraction in the process pool so other handlers keep running
+    async def attempt():
+        return await run_in_cpu_pool(loop, get_video_qualities, url)
+
+    deadline = loop.time() + EXTRACT_TIMEOUT
+    tasks = {asyncio.create_task(attempt())}
+    hedged = False
+
+    while tasks:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+
+        wait_time = remaining if hedged else min(remaining, EXTRACT_HEDGE_DELAY)
+        done, tasks = await asyncio.wait(tasks, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            try:
+                result, title_or_error, info = task.result()
+            except Exception as e:
+                last_error = str(e)
+                logging.error("Extraction attempt failed: %s", e)
+                continue
+            if result is not None:
+                qualities, title = result, title_or_error
+                video_id = extract_video_id(url)
+                if video_id:
+                    INFO_CACHE.set(video_id, info)
+                break
+            last_error = title_or_error
+
+        if qualities is not None:
+            break
+
+        # Only hedge a slow attempt; a hedge that would queue behind it just adds load
+        if not hedged and not done:
+            hedged = True
+            if cpu_pool_has_idle_worker():
+                logging.info("Extraction slow, starting hedged attempt")
+                tasks.add(asyncio.create_task(attempt()))
+            else:
+                logging.info("Extraction slow, but no idle worker to hedge with")
+
+    # Cancel any attempts still running
+    for task in tasks:
+        task.cancel()
+
+    if qualities is None and last_error is None:
+        last_error = f"Timeout after {EXTRACT_TIMEOUT}s"
+        logging.warning("Extraction timed out after %ss", EXTRACT_TIMEOUT)
+
+    if qualities is None:
+        return None, last_error
+    return qualities, title
+
+
+def get_thumbnail_task(video_id, url):
+    """Return a task downloading the video's thumbnail, reusing a recent or in-flight download."""
+    task = THUMBNAIL_CACHE.get(video_id) if video_id else None
+    if task:
+        return task
+
+    task = asyncio.create_task(fetch_thumbnail_bytes(url))
+    if video_id:
+        THUMBNAIL_CACHE.set(video_id, task)
+
+        def evict_failure(finished):
+            if (finished.cancelled() or not finished.result()) and THUMBNAIL_CACHE.get(video_id) is finished:
+                THUMBNAIL_CACHE.pop(video_id)
+
+        task.add_done_callback(evict_failure)
+    return task
+
+
+async def get_extraction(loop, video_id, url):
+    """Return (qualities, title) or (None, error message), reusing recent extractions.
+
+    Concurrent requests for the same video await one shared extraction task.
+    Links without a video ID are neither shared nor cached.
+    """
+    if not video_id:
+        return await extract_video_qualities(loop, url)
+
+    cached = EXTRACT_CACHE.get(video_id)
+    if cached:
+        logging.info("Using cached extraction for video ID: %s", video_id)
+        return cached
+
+    task = EXTRACT_TASKS.get(video_id)
+    if task is None:
+        async def extract_and_cache():
+            qualities, title = await extract_video_qualities(loop, url)
+            if qualities is not None:
+                EXTRACT_CACHE.set(video_id, (qualities, title))
+            return qualities, title
+
+        task = asyncio.create_task(extract_and_cache())
+        EXTRACT_TASKS[video_id] = task
+        task.add_done_callback(lambda _: EXTRACT_TASKS.pop(video_id, None))
+
+    # Shield the shared task so one cancelled request doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+
 async def handle_youtube_link(client, message):
     """Handle YouTube link messages."""
-    logging.info(f"Received YouTube link: {message.text}")
+    logging.info("Received YouTube link: %s", message.text)
 
     if not is_user_allowed(message.from_user.id):
-        logging.warning(f"Unauthorized access attempt from user {message.from_user.id}")
+        logging.warning("Unauthorized access attempt from user %s", message.from_user.id)
         return
 
     try:
         # Normalize the YouTube URL
         normalized_url = normalize_youtube_url(message.text)
-        logging.info(f"Normalized URL: {normalized_url}")
         
         # Send "processing" message
         logging.debug("Sending processing message")
         processing_msg = await message.reply_text("🔄 Processing video information...")
 
-        # Try extracting info with increasing timeouts
-        timeouts = [10, 20, 30]  # Try with 10s, then 20s, then 30s timeout
-        qualities = None
-        title = None
-        last_error = None
-
-        for timeout in timeouts:
-            try:
-                logging.info(f"Attempting extraction with {timeout}s timeout")
-
-                # Use asyncio.wait_for instead of asyncio.timeout
-                async def extract_with_timeout():
-                    return get_video_qualities(normalized_url)
-
-                qualities, title = await asyncio.wait_for(
-                    extract_with_timeout(),
-                    timeout=timeout
-                )
+        loop = asyncio.get_running_loop()
+        video_id = extract_video_id(normalized_url)
 
-                if qualities is not None:
-                    break
-            except asyncio.TimeoutError:
-                last_error = f"Timeout after {timeout}s"
-                logging.warning(f"Extraction timed out after {timeout}s")
-                continue
-            except Exception as e:
-                last_error = str(e)
-                logging.error(f"Extraction failed with timeout {timeout}s: {str(e)}")
-                continue
+        # Fetch the thumbnail while extraction runs, overlapping both round-trips
+        logging.debug("Attempting to download thumbnail")
+        thumb_task = get_thumbnail_task(video_id, normalized_url)
 
+        qualities, title = await get_extraction(loop, video_id, normalized_url)
         if qualities is None:
-            error_msg = f"❌ Error: {last_error or title}"
-            logging.error(f"Final extraction failure: {error_msg}")
+            error_msg = f"❌ Error: {title}"
+            logging.error("Final extraction failure: %s", error_msg)
             await processing_msg.edit_text(error_msg)
             return
 
-        logging.info(f"Successfully extracted video info: {title}")
-
-        # Download the thumbnail
-        logging.debug("Attempting to download thumbnail")
-        thumbnail_path = download_thumbnail(normalized_url)
-        if thumbnail_path:
-            logging.debug(f"Thumbnail downloaded to: {thumbnail_path}")
-        else:
-            logging.warning("Failed to download thumbnail")
+        logging.info("Successfully extracted video info: %s", title)
 
         # Create response message
         response = f"📹 **{title}**\n\nSelect video quality:"
@@ -967,51 +1544,53 @@ async def handle_youtube_link(client, message):
         # Create and attach inline keyboard
         logging.debug("Creating quality selection keyboard")
         keyboard = create_quality_keyboard(qualities, normalized_url)
+        remember_pending(message.chat.id, video_id, title, qualities)
 
-        if thumbnail_path and os.path.exists(thumbnail_path):
+        # Wait briefly for the thumbnail, then show the buttons without it rather than
+        # send a second keyboard later. The task may be shared with other requests, so
+        # it is shielded from this handler's timeout or cancellation.
+        thumb_bytes = None
+        try:
+            thumb_bytes = await asyncio.wait_for(asyncio.shield(thumb_task), THUMBNAIL_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.debug("Thumbnail still downloading after %ss, not waiting for it", THUMBNAIL_WAIT_TIMEOUT)
+
+        if not thumb_bytes:
+            logging.warning("No thumbnail available in time")
+        else:
             # Send the thumbnail with the response message and buttons
             try:
                 logging.debug("Sending response with thumbnail")
+                photo = io.BytesIO(thumb_bytes)
+                photo.name = f"thumbnail_{video_id}.jpg"
                 await client.send_photo(
                     chat_id=message.chat.id,
-                    photo=thumbnail_path,
+                    photo=photo,
                     caption=response,
                     reply_markup=keyboard
                 )
                 logging.info("Successfully sent response with thumbnail")
-            except Exception as e:
-                logging.error(f"Error sending photo: {str(e)}")
-                # Fallback to text-only message
-                logging.debug("Falling back to text-only message")
-                await processing_msg.edit_text(
-                    response,
-                    reply_markup=keyboard
-                )
-            finally:
-                # Clean up thumbnail file
+
+                # The photo replaces the processing message
                 try:
-                    if os.path.exists(thumbnail_path):
-                        os.remove(thumbnail_path)
-                        logging.debug("Thumbnail file cleaned up")
+                    await processing_msg.delete()
+                    logging.debug("Deleted processing message")
                 except Exception as e:
-                    logging.error(f"Error cleaning up thumbnail: {str(e)}")
-        else:
-            # Fallback to sending the response without a thumbnail
-            logging.debug("Sending text-only response (no thumbnail)")
-            await processing_msg.edit_text(
-                response,
-                reply_markup=keyboard
-            )
+                    logging.error("Error deleting processing message: %s", e)
+                return
+            except Exception as e:
+                logging.error("Error sending photo: %s", e)
+                logging.debug("Falling back to text-only message")
 
-        # Delete the processing message
-        try:
-            await processing_msg.delete()
-            logging.debug("Deleted processing message")
-        except Exception as e:
-            logging.error(f"Error deleting processing message: {str(e)}")
+        # Fallback to the response without a thumbnail
+        logging.debug("Sending text-only response (no thumbnail)")
+        await processing_msg.edit_text(
+            response,
+            reply_markup=keyboard
+        )
 
     except Exception as e:
-        logging.error(f"Unexpected error in handle_youtube_link: {str(e)}")
+        logging.error("Unexpected error in handle_youtube_link: %s", e)
         error_message = f"❌ Error processing video: {str(e)}"
         try:
             if 'processing_msg' in locals():
@@ -1019,11 +1598,9 @@ async def handle_youtube_link(client, message):
             else:
                 await message.reply_text(error_message)
         except Exception as send_error:
-            logging.error(f"Error sending error message: {str(send_error)}")
+            logging.error("Error sending error message: %s", send_error)
 
 
-@app.on_message(
-    filters.text & ~filters.command("start") & ~filters.regex(r'(https?://)?(www\.)?(youtube\.com|youtu\.be|music\.youtube\.com)/.*'))
 async def handle_invalid_input(message):
     """Handle invalid input."""
     if not is_user_allowed(message.from_user.id):
@@ -1035,7 +1612,6 @@ async def handle_invalid_input(message):
     )
 
 
-@app.on_callback_query()
 async def handle_quality_selection(client, callback_query):
     """Handle quality selection button presses."""
     try:
@@ -1043,12 +1619,12 @@ async def handle_quality_selection(client, callback_query):
         await callback_query.answer()
         
         # Extract format ID and video ID from callback data
-        data_parts = callback_query.data.split('_')
+        # (video IDs may contain underscores, so only split off the leading fields)
+        kind, _, rest = callback_query.data.partition('_')
 
-        if data_parts[0] == 'dl':
-            format_id = data_parts[1]
-            if len(data_parts) > 2:
-                video_id = '_'.join(data_parts[2:])
+        if kind == 'dl':
+            format_id, _, video_id = rest.partition('_')
+            if video_id:
                 
                 # Handle "unknown" video ID case
                 if video_id == "unknown":
@@ -1060,7 +1636,7 @@ async def handle_quality_selection(client, callback_query):
                 
                 # Reconstruct the YouTube URL from the video ID
                 video_url = f"https://www.youtube.com/watch?v={video_id}"
-                logging.info(f"Reconstructed URL from video ID: {video_url}")
+                logging.info("Reconstructed URL from video ID: %s", video_url)
                 
                 await download_and_send_video(client, callback_query, format_id, video_url)
             else:
@@ -1068,9 +1644,9 @@ async def handle_quality_selection(client, callback_query):
                 await callback_query.message.reply_text(
                     "⚠️ Video URL information missing. Please send the YouTube link again."
                 )
-        elif data_parts[0] == 'mp3':
-            if len(data_parts) > 1:
-                video_id = '_'.join(data_parts[1:])
+        elif kind == 'mp3':
+            video_id = rest
+            if video_id:
                 
                 # Handle special fallback cases
                 if video_id == "audio" or video_id == "unknown":
@@ -1082,7 +1658,7 @@ async def handle_quality_selection(client, callback_query):
                     
                 # Reconstruct the YouTube URL from the video ID
                 video_url = f"https://www.youtube.com/watch?v={video_id}"
-                logging.info(f"Reconstructed URL from video ID for audio: {video_url}")
+                logging.info("Reconstructed URL from video ID for audio: %s", video_url)
                 
                 await download_and_send_audio(client, callback_query, video_url)
             else:
@@ -1094,15 +1670,44 @@ async def handle_quality_selection(client, callback_query):
     except Exception as e:
         try:
             error_message = f"❌ Error: {str(e)}"
-            logging.error(f"Error in callback handler: {str(e)}", exc_info=True)
+            logging.error("Error in callback handler: %s", e, exc_info=True)
             await callback_query.message.reply_text(error_message)
         except Exception as send_error:
-            logging.error(f"Error sending error message: {str(send_error)}")
+            logging.error("Error sending error message: %s", send_error)
             pass
 
 
+def create_client():
+    """Create the bot client and register its handlers."""
+    client = Client(
+        "youtube_quality_bot",
+        api_id=os.getenv('API_ID'),
+        api_hash=os.getenv('API_HASH'),
+        bot_token=os.getenv('BOT_TOKEN')
+    )
+    client.add_handler(MessageHandler(start_command, filters.command("start")))
+    client.add_handler(MessageHandler(handle_youtube_link, filters.regex(YT_RE)))
+    client.add_handler(MessageHandler(
+        handle_invalid_input,
+        filters.text & ~filters.command("start") & ~filters.regex(YT_RE)))
+    client.add_handler(CallbackQueryHandler(handle_quality_selection))
+    return client
+
+
 # Run the bot
-print("✅ Bot is ready! Send me a YouTube link to get started.")
 if __name__ == "__main__":
+    print_startup_status()
+    install_uvloop()
+    DL_SEM = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    UPLOAD_SEM = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    cpu_pool = ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    open_file_id_db()
     clear_downloads_folder()  # Clear downloads folder on startup
-    app.run()
+    setup_download_path()
+    app = create_client()
+    print("✅ Bot is ready! Send me a YouTube link to get started.")
+    try:
+        app.run()
+    finally:
+        # Close pooled thumbnail connections on the client's loop to avoid "Unclosed client session"
+        app.loop.run_until_complete(close_http_session())